@@ -1,12 +1,22 @@
+import asyncio
+import functools
+import hashlib
+import logging
 import os
-import requests
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+import orjson
+from cachetools import TTLCache
 from google import genai
+from google.genai import types
 from fastapi import FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-from jose import jwt
-from supabase import create_client, Client
+from pydantic import BaseModel, ConfigDict
+from jose import jwk, jwt
 
 load_dotenv = lambda: None
 
@@ -17,25 +27,98 @@ load_dotenv = lambda: None
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = "gemini-1.5-flash"
+GEMINI_TIMEOUT_SECONDS = 60
+GEMINI_UNCONFIGURED_REPLY = "Gemini API not configured."
+GEMINI_EMPTY_REPLY = "[Gemini Error] Empty response"
+
+# Number of most recent messages sent to Gemini as conversation context
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "20"))
 
 if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
     raise RuntimeError("Supabase environment variables not set")
 
-supabase: Client = create_client(
-    SUPABASE_URL,
-    SUPABASE_SERVICE_ROLE_KEY,
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+log = logging.getLogger("thinklie")
+
+# Connections each worker may hold open to PostgREST. Keep
+# workers * SUPABASE_MAX_CONNECTIONS within what the Supabase plan allows.
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "50"))
+SUPABASE_MAX_KEEPALIVE = int(os.getenv("SUPABASE_MAX_KEEPALIVE", "20"))
+
+# Async PostgREST client shared by every request (keep-alive + HTTP/2),
+# so Supabase calls never block the event loop.
+postgrest = httpx.AsyncClient(
+    base_url=f"{SUPABASE_URL}/rest/v1",
+    headers={
+        "apikey": SUPABASE_SERVICE_ROLE_KEY,
+        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+    },
+    http2=True,
+    limits=httpx.Limits(
+        max_connections=SUPABASE_MAX_CONNECTIONS,
+        max_keepalive_connections=SUPABASE_MAX_KEEPALIVE,
+        keepalive_expiry=60.0,
+    ),
+    timeout=httpx.Timeout(5.0, pool=30.0),
 )
 
 JWKS_URL = f"{SUPABASE_URL}/auth/v1/keys"
+JWKS_REFRESH_SECONDS = 600
+JWKS_MISS_REFRESH_SECONDS = 30
+JWT_ALGORITHM = "ES256"
+
+# Current Supabase signing keys by kid, already constructed as jose key
+# objects so jwt.decode skips JWK parsing. Swapped wholesale by the
+# refresher task so key rotation is picked up without a restart.
+JWK_KEYS = {}
+jwks_client = httpx.AsyncClient(http2=True, timeout=5.0)
+
+# Unknown kids trigger at most one refetch per JWKS_MISS_REFRESH_SECONDS
+_jwks_miss_lock = asyncio.Lock()
+_jwks_miss_refreshed_at = 0.0
+
+# Verified JWT payloads keyed by SHA-256 of the token. The short TTL bounds
+# how long a revoked token keeps working; failures are never cached.
+_jwt_cache = TTLCache(maxsize=10000, ttl=30)
+
+# Dedicated HTTP/2 pool for Gemini, sized so many concurrent generations
+# reuse kept-alive connections instead of handshaking per call.
+gemini_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=1000, max_keepalive_connections=200),
+)
 
-client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
+# Recent Gemini replies keyed by the user and the exact contents sent, so an
+# identical prompt is answered without a second generation. Both messages
+# are still saved on a hit.
+_gemini_cache = TTLCache(maxsize=2000, ttl=60)
+
+client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=types.HttpOptions(
+        timeout=GEMINI_TIMEOUT_SECONDS * 1000,
+        httpx_async_client=gemini_http,
+    ),
+) if GEMINI_API_KEY else None
 security = HTTPBearer()
 
 # =================================================
 # FASTAPI APP
 # =================================================
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await load_jwks()
+    refresher = asyncio.create_task(_jwks_refresher())
+    yield
+    refresher.cancel()
+    await jwks_client.aclose()
+    await gemini_http.aclose()
+    await postgrest.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -45,190 +128,365 @@ app.add_middleware(
         "https://think-lie.vercel.app",
     ],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
 )
 
+# =================================================
+# DATABASE (PostgREST)
+# =================================================
+
+async def db_select_raw(table: str, params: dict):
+    # Rows come back as PostgREST's JSON bytes, untouched, so they can be
+    # forwarded to the client without a parse/serialize round trip.
+    response = await postgrest.get(f"/{table}", params=params)
+    response.raise_for_status()
+    return response.content
+
+
+_PREFER_REPRESENTATION = {"Prefer": "return=representation"}
+_PREFER_MINIMAL = {"Prefer": "return=minimal"}
+
+
+async def db_insert(table: str, row: dict, returning: bool = False):
+    response = await postgrest.post(
+        f"/{table}",
+        json=row,
+        headers=_PREFER_REPRESENTATION if returning else _PREFER_MINIMAL,
+    )
+    response.raise_for_status()
+    return response.json() if returning else None
+
+
+async def db_rpc(function: str, args: dict):
+    response = await postgrest.post(f"/rpc/{function}", json=args)
+    response.raise_for_status()
+    return response.json()
+
 # =================================================
 # AUTH
 # =================================================
 
-def get_jwks():
-    try:
-        return requests.get(JWKS_URL).json()
-    except Exception:
-        raise HTTPException(status_code=500, detail="Failed to fetch JWKS")
+async def load_jwks(retries: int = 3):
+    global JWK_KEYS
 
+    for attempt in range(retries):
+        try:
+            response = await jwks_client.get(JWKS_URL)
+            response.raise_for_status()
+            keys = {}
+            for k in response.json()["keys"]:
+                # Skip keys we can't use rather than dropping the whole set
+                try:
+                    keys[k["kid"]] = jwk.construct(k, k.get("alg", JWT_ALGORITHM))
+                except Exception:
+                    log.warning("Skipping unusable JWKS key %s", k.get("kid"), exc_info=True)
+            JWK_KEYS = keys
+            return
+        except Exception:
+            if attempt < retries - 1:
+                await asyncio.sleep(2 ** attempt)
+            else:
+                log.warning("JWKS fetch failed after %d attempts", retries, exc_info=True)
+
+
+async def _jwks_refresher():
+    while True:
+        await asyncio.sleep(JWKS_REFRESH_SECONDS)
+        await load_jwks()
+
+
+async def refresh_jwks_on_miss():
+    global _jwks_miss_refreshed_at
+
+    async with _jwks_miss_lock:
+        if time.monotonic() - _jwks_miss_refreshed_at < JWKS_MISS_REFRESH_SECONDS:
+            return
+        _jwks_miss_refreshed_at = time.monotonic()
+        await load_jwks(retries=1)
+
+
+# Verification settings bound once instead of rebuilt on every call
+_decode_token = functools.partial(
+    jwt.decode,
+    algorithms=[JWT_ALGORITHM],
+    audience="authenticated",
+    options={"require_sub": True, "require_exp": True, "require_aud": True},
+)
 
-def verify_supabase_token(token: str):
 
-    try:
-        jwks = get_jwks()
+async def verify_supabase_token(token: str):
+
+    cache_key = hashlib.sha256(token.encode()).digest()
+
+    cached = _jwt_cache.get(cache_key)
+    if cached is not None and cached["exp"] > time.time():
+        return cached
 
+    try:
         header = jwt.get_unverified_header(token)
         kid = header["kid"]
 
-        key = None
-        for k in jwks["keys"]:
-            if k["kid"] == kid:
-                key = k
-                break
+        key = JWK_KEYS.get(kid)
 
         if key is None:
-            raise HTTPException(status_code=401, detail="Public key not found")
+            # The signing key may have been rotated since the last fetch
+            await refresh_jwks_on_miss()
+            key = JWK_KEYS.get(kid)
 
-        payload = jwt.decode(
-            token,
-            key,
-            algorithms=["ES256"],
-            audience="authenticated",
-        )
+        if key is None:
+            raise HTTPException(status_code=401, detail="Public key not found")
 
-        return payload
+        payload = _decode_token(token, key)
 
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
 
+    _jwt_cache[cache_key] = payload
 
-def get_current_user(
+    return payload
+
+
+async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
 ):
     token = credentials.credentials
-    payload = verify_supabase_token(token)
-
-    user_id = payload.get("sub")
+    payload = await verify_supabase_token(token)
 
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid token payload")
-
-    return user_id
+    return payload["sub"]
 
 # =================================================
 # SCHEMAS
 # =================================================
 
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(str_max_length=100_000)
+
     message: str
 
 # =================================================
 # ROOT
 # =================================================
 
+# Static payload, encoded once for the load balancer health checks
+_ROOT_BYTES = orjson.dumps({
+    "status": "Backend live (Supabase edition)",
+    "version": "4.0.0",
+})
+
+
 @app.get("/")
-def root():
-    return {
-        "status": "Backend live (Supabase edition)",
-        "version": "4.0.0",
-    }
+async def root():
+    return Response(_ROOT_BYTES, media_type="application/json")
 
 # =================================================
 # 1️⃣ CREATE CHAT
 # =================================================
 
 @app.post("/chats")
-def create_chat(user_id: str = Depends(get_current_user)):
+async def create_chat(user_id: str = Depends(get_current_user)):
 
     data = {
         "user_id": user_id,
         "title": "New Chat",
     }
 
-    response = supabase.table("chats").insert(data).execute()
+    rows = await db_insert("chats", data, returning=True)
 
-    if not response.data:
+    if not rows:
         raise HTTPException(status_code=400, detail="Failed to create chat")
 
-    return {"chat": response.data[0]}
+    return {"chat": rows[0]}
 
 # =================================================
 # 2️⃣ LIST USER CHATS
 # =================================================
 
 @app.get("/chats")
-def list_chats(user_id: str = Depends(get_current_user)):
-
-    response = (
-        supabase.table("chats")
-        .select("*")
-        .eq("user_id", user_id)
-        .order("created_at", desc=True)
-        .execute()
-    )
+async def list_chats(user_id: str = Depends(get_current_user)):
+
+    chats = await db_select_raw("chats", {
+        "select": "*",
+        "user_id": f"eq.{user_id}",
+        "order": "created_at.desc",
+    })
 
-    return {"chats": response.data}
+    return Response(b'{"chats":' + chats + b"}", media_type="application/json")
 
 # =================================================
 # 3️⃣ GET MESSAGES
 # =================================================
 
 @app.get("/chats/{chat_id}/messages")
-def get_messages(chat_id: str, user_id: str = Depends(get_current_user)):
-
-    response = (
-        supabase.table("messages")
-        .select("*")
-        .eq("chat_id", chat_id)
-        .eq("user_id", user_id)
-        .order("created_at")
-        .execute()
-    )
+async def get_messages(chat_id: str, user_id: str = Depends(get_current_user)):
 
-    return response.data
+    messages = await db_select_raw("messages", {
+        "select": "*",
+        "chat_id": f"eq.{chat_id}",
+        "user_id": f"eq.{user_id}",
+        "order": "created_at",
+    })
+
+    return Response(messages, media_type="application/json")
 
 # =================================================
 # 4️⃣ SEND MESSAGE
 # =================================================
 
+GEMINI_ROLES = {"user": "user", "assistant": "model"}
+
+
+async def save_user_message(chat_id: str, user_id: str, content: str):
+
+    # Save user message and fetch the latest history window in one round trip
+    history = await db_rpc("send_message_tx", {
+        "p_chat": chat_id,
+        "p_user": user_id,
+        "p_content": content,
+        "p_limit": HISTORY_WINDOW,
+    })
+
+    # Empty or NULL content would become an empty text part, which Gemini
+    # rejects, so leave those rows out of the context
+    history = [m for m in history if m["content"]]
+
+    # A fixed-size window can open on an assistant turn, but Gemini expects
+    # the conversation to start with the user, so drop any leading replies
+    start = 0
+    while start < len(history) and history[start]["role"] == "assistant":
+        start += 1
+
+    return [to_gemini_content(m) for m in history[start:]]
+
+
+def to_gemini_content(message: dict):
+    return {
+        "role": GEMINI_ROLES[message["role"]],
+        "parts": [{"text": message["content"]}],
+    }
+
+
+async def save_assistant_message(chat_id: str, user_id: str, content: str):
+    try:
+        await db_insert("messages", {
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "role": "assistant",
+            "content": content,
+        })
+    except Exception:
+        log.exception("Saving assistant reply failed for chat %s", chat_id)
+
+
 @app.post("/chats/{chat_id}/message")
-def send_message(
+async def send_message(
     chat_id: str,
     request: ChatRequest,
     user_id: str = Depends(get_current_user),
 ):
 
-    # Save user message
-    supabase.table("messages").insert({
-        "chat_id": chat_id,
-        "user_id": user_id,
-        "role": "user",
-        "content": request.message,
-    }).execute()
-
-    # Fetch chat history
-    history_response = (
-        supabase.table("messages")
-        .select("*")
-        .eq("chat_id", chat_id)
-        .eq("user_id", user_id)
-        .order("created_at")
-        .execute()
-    )
-
-    history = history_response.data
-
-    context = "\n".join(
-        [f"{m['role']}: {m['content']}" for m in history]
-    )
+    contents = await save_user_message(chat_id, user_id, request.message)
+    reply_key = gemini_cache_key(user_id, contents)
+    cached_reply = _gemini_cache.get(reply_key)
 
     # Generate AI response
     if not client:
-        ai_response = "Gemini API not configured."
+        ai_response = GEMINI_UNCONFIGURED_REPLY
+    elif cached_reply is not None:
+        ai_response = cached_reply
     else:
         try:
-            response = client.models.generate_content(
-                model="gemini-1.5-flash",
-                contents=context,
+            response = await asyncio.wait_for(
+                client.aio.models.generate_content(
+                    model=GEMINI_MODEL,
+                    contents=contents,
+                ),
+                timeout=GEMINI_TIMEOUT_SECONDS,
             )
-            ai_response = response.text
+            if response.text:
+                ai_response = response.text
+                _gemini_cache[reply_key] = ai_response
+            else:
+                ai_response = GEMINI_EMPTY_REPLY
+        except asyncio.TimeoutError:
+            log.warning("Gemini request timed out for chat %s", chat_id)
+            ai_response = "[Gemini Error] Request timed out"
         except Exception as e:
+            log.exception("Gemini request failed for chat %s", chat_id)
             ai_response = f"[Gemini Error] {str(e)}"
 
-    # Save assistant message
-    supabase.table("messages").insert({
-        "chat_id": chat_id,
-        "user_id": user_id,
-        "role": "assistant",
-        "content": ai_response,
-    }).execute()
+    # Save assistant message before replying so the next send sees it
+    await save_assistant_message(chat_id, user_id, ai_response)
+
+    return {"reply": ai_response}
+
+# =================================================
+# 5️⃣ SEND MESSAGE (STREAMING)
+# =================================================
+
+@app.post("/chats/{chat_id}/message/stream")
+async def stream_message(
+    chat_id: str,
+    request: ChatRequest,
+    user_id: str = Depends(get_current_user),
+):
 
-    return {"reply": ai_response}
\ No newline at end of file
+    contents = await save_user_message(chat_id, user_id, request.message)
+    reply_key = gemini_cache_key(user_id, contents)
+    cached_reply = _gemini_cache.get(reply_key)
+    chunks = []
+
+    async def events():
+        if not client:
+            chunks.append(GEMINI_UNCONFIGURED_REPLY)
+            yield sse_event(chunks[-1])
+        elif cached_reply is not None:
+            chunks.append(cached_reply)
+            yield sse_event(chunks[-1])
+        else:
+            error = None
+            # One deadline for the whole generation, applied to every wait on
+            # Gemini but not to time spent yielding to a slow client
+            deadline = asyncio.get_running_loop().time() + GEMINI_TIMEOUT_SECONDS
+            try:
+                async with asyncio.timeout_at(deadline):
+                    stream = await client.aio.models.generate_content_stream(
+                        model=GEMINI_MODEL,
+                        contents=contents,
+                    )
+                while True:
+                    async with asyncio.timeout_at(deadline):
+                        chunk = await anext(stream, None)
+                    if chunk is None:
+                        break
+                    if chunk.text:
+                        chunks.append(chunk.text)
+                        yield sse_event(chunk.text)
+                if chunks:
+                    _gemini_cache[reply_key] = "".join(chunks)
+            except asyncio.TimeoutError:
+                log.warning("Gemini stream timed out for chat %s", chat_id)
+                error = "[Gemini Error] Request timed out"
+            except Exception as e:
+                log.exception("Gemini stream failed for chat %s", chat_id)
+                error = f"[Gemini Error] {str(e)}"
+
+            # A reply cut off mid-stream is kept as is; the error text only
+            # stands in when Gemini produced nothing at all
+            if not chunks:
+                chunks.append(error or GEMINI_EMPTY_REPLY)
+                yield sse_event(chunks[-1])
+
+        # Persist the full reply before the stream closes, so the client
+        # can't send its next message ahead of this row
+        await save_assistant_message(chat_id, user_id, "".join(chunks))
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def gemini_cache_key(user_id: str, contents: list):
+    return hashlib.sha256(user_id.encode() + orjson.dumps(contents)).digest()
+
+
+def sse_event(delta: str):
+    return b"data: " + orjson.dumps({"delta": delta}) + b"\n\n"
@@ -1,5 +1,5 @@
 import os
-import requests
+import httpx
 from fastapi import APIRouter, HTTPException
 from .schemas import SignupRequest, LoginRequest, TokenResponse
 
@@ -7,17 +7,24 @@ from .schemas import SignupRequest, LoginRequest, TokenResponse
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 
+# One pooled client for every auth call, so signups and logins reuse
+# keep-alive connections instead of handshaking with Supabase each time
+supabase_auth = httpx.AsyncClient(
+    base_url=f"{SUPABASE_URL}/auth/v1",
+    headers={"apikey": SUPABASE_ANON_KEY or ""},
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50),
+    timeout=10.0,
+)
+
 router = APIRouter()
 
+
 @router.post("/signup", response_model=TokenResponse)
-def signup(req: SignupRequest):
+async def signup(req: SignupRequest):
     """Register a new user with Supabase"""
-    response = requests.post(
-        f"{SUPABASE_URL}/auth/v1/signup",
-        headers={
-            "apikey": SUPABASE_ANON_KEY,
-            "Content-Type": "application/json"
-        },
+    response = await supabase_auth.post(
+        "/signup",
         json={
             "email": req.email,
             "password": req.password
@@ -37,14 +44,11 @@ def signup(req: SignupRequest):
     }
 
 @router.post("/login", response_model=TokenResponse)
-def login(req: LoginRequest):
+async def login(req: LoginRequest):
     """Login user with Supabase"""
-    response = requests.post(
-        f"{SUPABASE_URL}/auth/v1/token?grant_type=password",
-        headers={
-            "apikey": SUPABASE_ANON_KEY,
-            "Content-Type": "application/json"
-        },
+    response = await supabase_auth.post(
+        "/token",
+        params={"grant_type": "password"},
         json={
             "email": req.email,
             "password": req.password
@@ -0,0 +1,17 @@
+import os
+
+# =================================================
+# GUNICORN CONFIG
+# =================================================
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# cpu_count() reports the host's cores inside a container, so size from the
+# CPUs this process may actually run on and cap it to stay well under the
+# Supabase connection limit (each worker holds its own pool)
+workers = int(os.getenv("WEB_CONCURRENCY", min(len(os.sched_getaffinity(0)), 4)))
+# UvicornWorker picks up uvloop and httptools from requirements.txt
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Import app.py once in the master so workers share it copy-on-write
+preload_app = True
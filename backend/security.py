@@ -3,11 +3,23 @@ from jose import jwt
 from datetime import datetime, timedelta
 import os
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# argon2id for new hashes; existing bcrypt hashes still verify and are
+# flagged for rehash by deprecated="auto"
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__time_cost=2,
+    argon2__memory_cost=19456,
+    argon2__parallelism=1,
+)
 
 SECRET_KEY = os.getenv("JWT_SECRET")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
+ACCESS_TOKEN_EXPIRE = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+
+if not SECRET_KEY:
+    raise RuntimeError("JWT_SECRET environment variable not set")
 
 def hash_password(password: str):
     return pwd_context.hash(password)
@@ -17,6 +29,6 @@ def verify_password(password, hash):
 
 def create_access_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    expire = datetime.utcnow() + ACCESS_TOKEN_EXPIRE
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)